@@ -2,14 +2,32 @@
 # FastAPI app; endpoint: POST /ingest
 # Auth: ?token=<TELEM_URL_TOKEN>  or  Authorization: Bearer <TELEM_SECRET>
 # Storage: SQLite + rolling CSV in DATA_DIR. Works on Render (ephemeral or Disk).
+# Linux deploys pin --loop uvloop --http httptools (render.yaml); uvicorn[standard]
+# skips uvloop on Windows/PyPy, where the default --loop auto falls back to asyncio.
 
-import os, io, csv, hashlib, sqlite3, datetime as dt
-from typing import Optional, Dict, Any
+import os, io, csv, json, hmac, atexit, queue, hashlib, sqlite3, asyncio, logging, threading, time, datetime as dt
+from collections import OrderedDict
+from itertools import chain, groupby
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, Dict, Tuple, Any
 from fastapi import FastAPI, Request, HTTPException, Header, Query
 from fastapi.responses import JSONResponse, StreamingResponse
 
+try:
+    from xxhash import xxh3_64_intdigest as hash64
+except ImportError:  # stdlib fallback, same 64-bit int shape
+    def hash64(b: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(b, digest_size=8).digest(), "little")
+
+try:
+    import orjson  # noqa: F401  (ORJSONResponse needs it at render time)
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:  # stdlib json fallback
+    FastJSONResponse = JSONResponse
+
 # ---------- config & env ----------
 APP_NAME = os.getenv("APP_NAME", "Heimdall-GPS")
+log = logging.getLogger("heimdall")
 
 def getenv_any(*names: str, default: str = "") -> str:
     for n in names:
@@ -23,6 +41,8 @@ URL_TOKEN    = getenv_any("TELEM_URL_TOKEN", "TELEM_TOKEN", "TELEM_URL",
                           default="0bb658f5cbaa696a882487a4fcb89bab")
 HEADER_SECRET = getenv_any("TELEM_SECRET", "API_SECRET",
                            default="c9a9f6748a941a4177c827c67155c975")
+_URL_TOKEN_B = URL_TOKEN.encode()
+_HEADER_SECRET_B = HEADER_SECRET.encode()
 
 # Data dir: prefer provided path, else safe writeable path on Render
 DATA_DIR = getenv_any("EXPORT_DIR", "DATA_DIR", default="/var/tmp/heimdall")
@@ -34,16 +54,77 @@ except PermissionError:
 
 DB_PATH = os.path.join(DATA_DIR, "telem.db")
 
+# telemetry lines are a few hundred bytes; anything bigger is rejected unread
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "4096"))
+
+# write batching: flush after this many rows or this many ms, whichever first
+FLUSH_MAX_ROWS = int(os.getenv("FLUSH_MAX_ROWS", "500"))
+FLUSH_MAX_MS   = int(os.getenv("FLUSH_MAX_MS", "50"))
+
+# WAL checkpoints run from a background task instead of inline on a commit
+WAL_CHECKPOINT_SECS = int(os.getenv("WAL_CHECKPOINT_SECS", "30"))
+
 # ---------- utils ----------
 def utc_ts() -> int:
-    return int(dt.datetime.utcnow().timestamp())
+    return time.time_ns() // 1_000_000_000
 
-def db():
-    conn = sqlite3.connect(DB_PATH, timeout=15, isolation_level=None)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
+# cached connections for the whole process; PRAGMAs + DDL run once at startup.
+# One writer (serialized by _write_lock) + a small pool of read-only readers:
+# under WAL each reader sees the last committed snapshot and never waits on
+# the writer, and concurrent exports don't queue behind one connection.
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "4"))
+READ_POOL_WAIT_SECS = float(os.getenv("READ_POOL_WAIT_SECS", "5"))
+_RW_CONN: Optional[sqlite3.Connection] = None
+_ro_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+_write_lock = threading.Lock()
+
+# per-connection tuning; journal_mode/synchronous are writer-only (WAL is
+# persistent in the file, so the reader inherits it). connect(timeout=15)
+# already installs the busy handler, so no busy_timeout PRAGMA is needed.
+_CONN_PRAGMAS = ("temp_store=MEMORY", "cache_size=-64000", "mmap_size=268435456")
+
+def db() -> sqlite3.Connection:
+    global _RW_CONN
+    if _RW_CONN is None:
+        conn = sqlite3.connect(DB_PATH, timeout=15, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA wal_autocheckpoint=0;")  # see checkpointer()
+        for p in _CONN_PRAGMAS:
+            conn.execute(f"PRAGMA {p};")
+        _RW_CONN = conn
+    return _RW_CONN
+
+def open_ro() -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=15,
+                           isolation_level=None, check_same_thread=False)
+    for p in _CONN_PRAGMAS:
+        conn.execute(f"PRAGMA {p};")
     return conn
 
+@contextmanager
+def ro_db():
+    # bounded wait: stalled downloads can hold every reader, and an unbounded
+    # get() would pin threadpool workers until /health starves too
+    try:
+        conn = _ro_pool.get(timeout=READ_POOL_WAIT_SECS)
+    except queue.Empty:
+        raise HTTPException(status_code=503, detail="Database readers busy, retry later")
+    try:
+        yield conn
+    finally:
+        _ro_pool.put(conn)
+
+def close_db():
+    global _RW_CONN
+    while not _ro_pool.empty():
+        _ro_pool.get_nowait().close()
+    with _write_lock:
+        if _RW_CONN is not None:
+            _RW_CONN.close()
+            _RW_CONN = None
+
 def init_db():
     conn = db()
     conn.execute("""CREATE TABLE IF NOT EXISTS trades(
@@ -54,7 +135,8 @@ def init_db():
         mx TEXT, rs TEXT, wr20 REAL,
         src TEXT, raw TEXT
     );""")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_sym_tf_ts ON trades(sym, tf, ts_utc);")
+    # /export/* filters + orders by ts_utc alone; without this it scans and sorts
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_ts ON trades(ts_utc);")
     conn.execute("""CREATE TABLE IF NOT EXISTS market(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         ts_utc INTEGER NOT NULL,
@@ -64,137 +146,289 @@ def init_db():
         sess TEXT, fp TEXT,
         src TEXT, raw TEXT
     );""")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_market_sym_tf_ts ON market(sym, tf, ts_utc);")
-    conn.close()
-
-init_db()
-
-# small in-memory dedupe (for TV retries)
-_recent = set()
-def seen(msg: str) -> bool:
-    h = hashlib.sha1(msg.encode("utf-8")).hexdigest()
-    if h in _recent: return True
-    _recent.add(h)
-    if len(_recent) > 2000:
-        for _ in range(500):
-            _recent.pop()
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_market_ts ON market(ts_utc);")
+    # no query filters on (sym, tf); drop the old indexes so inserts stop paying for them
+    conn.execute("DROP INDEX IF EXISTS idx_trades_sym_tf_ts;")
+    conn.execute("DROP INDEX IF EXISTS idx_market_sym_tf_ts;")
+    # file + schema exist now, so mode=ro can open
+    for _ in range(READ_POOL_SIZE - _ro_pool.qsize()):
+        _ro_pool.put(open_ro())
+
+# column order shared by the INSERTs, the queued row tuples and the CSV header
+TRADE_COLS = ("ts_utc","sym","tf","verb","persona","ag","al","hr","ds","sl",
+              "mx","rs","wr20","src","raw")
+MARKET_COLS = ("ts_utc","sym","tf","p","v","atr","bbw","al","hr","rg","mx",
+               "adx","bb","liq","spr","sess","fp","src","raw")
+COLS = {"trades": TRADE_COLS, "market": MARKET_COLS}
+
+# same SQL text every call -> sqlite3's per-connection statement cache
+# hands back the already-prepared statement on the cached writer
+_INS_TRADE = (f"INSERT INTO trades({','.join(TRADE_COLS)}) "
+              f"VALUES({','.join('?' * len(TRADE_COLS))})")
+_INS_MARKET = (f"INSERT INTO market({','.join(MARKET_COLS)}) "
+               f"VALUES({','.join('?' * len(MARKET_COLS))})")
+
+# small in-memory dedupe (for TV retries); 64-bit hashes in LRU order
+DEDUPE_MAX = 2048
+_recent: "OrderedDict[int, None]" = OrderedDict()
+def seen(msg: bytes) -> bool:
+    h = hash64(msg)
+    if h in _recent:
+        _recent.move_to_end(h)
+        return True
+    _recent[h] = None
+    if len(_recent) > DEDUPE_MAX:
+        _recent.popitem(last=False)
     return False
 
 def kv_parse(msg: str):
-    parts = msg.strip().split("|")
-    if not parts: return "", {}
-    prefix = parts[0]
+    # "|key=value" pairs; key runs to the first "=", parts without one are skipped
+    prefix, *parts = msg.strip().split("|")
     kv = {}
-    for p in parts[1:]:
-        if "=" in p:
-            k, v = p.split("=", 1)
+    for p in parts:
+        k, eq, v = p.partition("=")
+        if eq:
             kv[k.strip()] = v.strip()
     return prefix, kv
 
 def norm_tf(s: Optional[str]) -> str:
     return s.strip() if s else "na"
 
-def write_csv(kind: str, row: Dict[str, Any]):
-    day = dt.datetime.utcfromtimestamp(row["ts_utc"]).strftime("%Y%m%d")
-    path = os.path.join(DATA_DIR, f"{kind}_{day}.csv")
-    new = not os.path.exists(path)
-    with open(path, "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=list(row.keys()))
-        if new: w.writeheader()
-        w.writerow(row)
+def write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+# kind -> (UTC day number, fd): today's file stays open between batches and
+# is swapped for the next day's on the first row past UTC midnight
+_csv_fds: Dict[str, Tuple[int, int]] = {}
+
+def csv_fd(kind: str, day_no: int) -> Tuple[int, bool]:
+    cached = _csv_fds.get(kind)
+    if cached and cached[0] == day_no:
+        return cached[1], False
+    if cached:
+        # forget it before closing: if the open below fails, a later call must
+        # not close the same fd number again (the kernel may have reused it)
+        del _csv_fds[kind]
+        os.close(cached[1])
+    day = time.strftime("%Y%m%d", time.gmtime(day_no * 86400))
+    fd = os.open(os.path.join(DATA_DIR, f"{kind}_{day}.csv"),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _csv_fds[kind] = (day_no, fd)
+    return fd, os.fstat(fd).st_size == 0
+
+def close_csv():
+    while _csv_fds:
+        _, fd = _csv_fds.popitem()[1]
+        os.close(fd)
+
+# lifespan shutdown normally does this; atexit covers scripts/REPLs that
+# import the module and write without ever running the app's lifespan
+atexit.register(close_csv)
+
+def write_csv(kind: str, rows):
+    # rows are COLS[kind]-ordered tuples in queue (= time) order; ts_utc picks
+    # the daily file. Each same-day run is rendered in memory and appended
+    # with a single write() on the cached O_APPEND fd.
+    for day_no, run in groupby(rows, key=lambda vals: vals[0] // 86400):
+        fd, new = csv_fd(kind, day_no)
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        if new: w.writerow(COLS[kind])
+        w.writerows(run)
+        write_all(fd, buf.getvalue().encode("utf-8"))
+
+# ---------- write batching ----------
+# store_* only enqueue; one background task commits rows in batches so the
+# per-transaction fsync is paid once per batch instead of once per webhook,
+# then appends the same batch to the daily CSVs (one write per file per batch).
+_queue: Optional[asyncio.Queue] = None  # created in lifespan, on the serving loop
+
+def flush_rows(batch):
+    trades = [vals for kind, vals in batch if kind == "trades"]
+    market = [vals for kind, vals in batch if kind == "market"]
+    with _write_lock:
+        conn = db()
+        conn.execute("BEGIN")
+        try:
+            if trades:
+                conn.executemany(_INS_TRADE, trades)
+            if market:
+                conn.executemany(_INS_MARKET, market)
+            conn.execute("COMMIT")
+        except Exception:
+            # a failed COMMIT can leave the txn open; never leave the writer in it
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    if trades:
+        write_csv("trades", trades)
+    if market:
+        write_csv("market", market)
+
+_STOP = None  # queued by lifespan shutdown; flusher commits what it holds and exits
+
+async def flusher():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = loop.time() + FLUSH_MAX_MS / 1000
+        while len(batch) < FLUSH_MAX_ROWS:
+            if not _queue.empty():
+                item = _queue.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            await asyncio.to_thread(flush_rows, batch)
+        except Exception:
+            log.exception("flush of %d rows failed", len(batch))
+
+# kv -> column mapping, one entry per column between the fixed head
+# (ts_utc, sym, tf[, verb]) and tail (src, raw): (kv keys tried in order, cast).
+# cast=None keeps the string; numeric casts only see non-empty values.
+_TRADE_FIELDS = (
+    (("sq", "p"), None),          # persona
+    (("ag",), int),
+    (("al",), float),
+    (("hr",), float),
+    (("ds",), float),
+    (("sl",), float),
+    (("mx",), None),
+    (("rs", "reg"), None),        # rs
+    (("wr20",), float),
+)
+_MARKET_FIELDS = (
+    (("p",), float),
+    (("v",), float),
+    (("atr",), float),
+    (("bbw", "bb"), float),       # bbw
+    (("al",), float),
+    (("hr",), float),
+    (("rg", "regime", "reg"), None),  # rg
+    (("mx",), None),
+    (("adx",), float),
+    (("bb",), float),
+    (("liq",), float),
+    (("spr",), float),
+    (("sess",), None),
+    (("fp",), None),
+)
+
+def make_builder(fields):
+    # Compile the schema into one straight-line function at import, e.g.
+    #   (g("sq") or g("p"), (int(v) if (v := g("ag")) else None), ...)
+    # so a store call is a single tuple expression: no per-field loop or call.
+    # Same rules as reading the table by hand: first non-empty alias wins,
+    # empty numerics become None, strings pass through as-is.
+    exprs = []
+    for keys, cast in fields:
+        get = " or ".join(f"g({k!r})" for k in keys)
+        exprs.append(get if cast is None else f"({cast.__name__}(v) if (v := {get}) else None)")
+    ns: Dict[str, Any] = {}
+    exec(f"def build(g):\n    return ({', '.join(exprs)},)\n", {"int": int, "float": float}, ns)
+    return ns["build"]
+
+_build_trade = make_builder(_TRADE_FIELDS)
+_build_market = make_builder(_MARKET_FIELDS)
 
 def store_trade(raw: str, kv: Dict[str,str], src: str):
-    ts = utc_ts()
-    verb = kv.get("sig") or kv.get("verb") or raw.split("|",1)[0]
-    row = {
-        "ts_utc": ts,
-        "sym": kv.get("sym", "na"),
-        "tf": norm_tf(kv.get("tf")),
-        "verb": verb,
-        "persona": kv.get("sq") or kv.get("p"),
-        "ag": int(kv.get("ag","0")) if kv.get("ag") else None,
-        "al": float(kv.get("al","0")) if kv.get("al") else None,
-        "hr": float(kv.get("hr","0")) if kv.get("hr") else None,
-        "ds": float(kv.get("ds","0")) if kv.get("ds") else None,
-        "sl": float(kv.get("sl","0")) if kv.get("sl") else None,
-        "mx": kv.get("mx"),
-        "rs": kv.get("rs") or kv.get("reg"),
-        "wr20": float(kv.get("wr20","0")) if kv.get("wr20") else None,
-        "src": src,
-        "raw": raw
-    }
-    conn = db()
-    conn.execute("""INSERT INTO trades(ts_utc,sym,tf,verb,persona,ag,al,hr,ds,sl,mx,rs,wr20,src,raw)
-                    VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                 (row["ts_utc"], row["sym"], row["tf"], row["verb"], row["persona"],
-                  row["ag"], row["al"], row["hr"], row["ds"], row["sl"],
-                  row["mx"], row["rs"], row["wr20"], row["src"], row["raw"]))
-    conn.close()
-    write_csv("trades", row)
+    g = kv.get
+    verb = g("sig") or g("verb") or raw.split("|",1)[0]
+    _queue.put_nowait(("trades", (
+        utc_ts(), g("sym", "na"), norm_tf(g("tf")), verb,
+        *_build_trade(g), src, raw)))
 
 def store_market(raw: str, kv: Dict[str,str], src: str):
-    ts = utc_ts()
-    row = {
-        "ts_utc": ts,
-        "sym": kv.get("sym","na"),
-        "tf": norm_tf(kv.get("tf")),
-        "p":  float(kv.get("p","0")) if kv.get("p") else None,
-        "v":  float(kv.get("v","0")) if kv.get("v") else None,
-        "atr":float(kv.get("atr","0")) if kv.get("atr") else None,
-        "bbw":float(kv.get("bbw","0")) if kv.get("bbw") else (float(kv.get("bb","0")) if kv.get("bb") else None),
-        "al": float(kv.get("al","0")) if kv.get("al") else None,
-        "hr": float(kv.get("hr","0")) if kv.get("hr") else None,
-        "rg": kv.get("rg") or kv.get("regime") or kv.get("reg"),
-        "mx": kv.get("mx"),
-        "adx":float(kv.get("adx","0")) if kv.get("adx") else None,
-        "bb": float(kv.get("bb","0")) if kv.get("bb") else None,
-        "liq":float(kv.get("liq","0")) if kv.get("liq") else None,
-        "spr":float(kv.get("spr","0")) if kv.get("spr") else None,
-        "sess": kv.get("sess"),
-        "fp":   kv.get("fp"),
-        "src":  src,
-        "raw":  raw
-    }
-    conn = db()
-    conn.execute("""INSERT INTO market(ts_utc,sym,tf,p,v,atr,bbw,al,hr,rg,mx,adx,bb,liq,spr,sess,fp,src,raw)
-                    VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                 (row["ts_utc"], row["sym"], row["tf"], row["p"], row["v"], row["atr"], row["bbw"],
-                  row["al"], row["hr"], row["rg"], row["mx"], row["adx"], row["bb"], row["liq"],
-                  row["spr"], row["sess"], row["fp"], row["src"], row["raw"]))
-    conn.close()
-    write_csv("market", row)
+    g = kv.get
+    _queue.put_nowait(("market", (
+        utc_ts(), g("sym", "na"), norm_tf(g("tf")),
+        *_build_market(g), src, raw)))
+
+# prefix -> (store fn, src, kind, verb default); EL/ES/... carry the verb in the prefix
+_TRADE = (store_trade, "F34", "trade")
+_MARKET = (store_market, "HEIMDALL", "market")
+_DISPATCH = {
+    **{pf: (*_TRADE, pf) for pf in ("EL","ES","XL","XS","XA")},
+    **{pf: (*_TRADE, None) for pf in ("TELEM","TRD","TRADE")},
+    **{pf: (*_MARKET, None) for pf in ("PSY","MKT","MKT2")},
+}
+_TRADE_KEYS = frozenset(("sig","verb"))
+_MARKET_KEYS = frozenset(("adx","bbw","liq","fp","spr"))
+
+def infer_kind(kv: Dict[str,str]):
+    # no known prefix: fall back to which keys the payload carries
+    if not _TRADE_KEYS.isdisjoint(kv):
+        return (*_TRADE, None)
+    if not _MARKET_KEYS.isdisjoint(kv):
+        return (*_MARKET, None)
+    raise ValueError("Unrecognized payload")
 
 def classify_and_store(raw: str):
     prefix, kv = kv_parse(raw)
-    pf = prefix.upper()
-    if pf in ("EL","ES","XL","XS","XA"):
-        kv.setdefault("verb", pf)
-        store_trade(raw, kv, src="F34")
-        return "trade"
-    if pf in ("TELEM","TRD","TRADE"):
-        store_trade(raw, kv, src="F34")
-        return "trade"
-    if pf in ("PSY","MKT","MKT2"):
-        store_market(raw, kv, src="HEIMDALL")
-        return "market"
-    if "sig" in kv or "verb" in kv:
-        store_trade(raw, kv, src="F34")
-        return "trade"
-    if any(k in kv for k in ("adx","bbw","liq","fp","spr")):
-        store_market(raw, kv, src="HEIMDALL")
-        return "market"
-    raise ValueError("Unrecognized payload")
+    # Pine always sends upper-case prefixes; only fall back to upper() on a miss
+    route = _DISPATCH.get(prefix) or _DISPATCH.get(prefix.upper()) or infer_kind(kv)
+    store, src, kind, verb = route
+    if verb:
+        kv.setdefault("verb", verb)
+    store(raw, kv, src=src)
+    return kind
 
-app = FastAPI(title=APP_NAME)
+def checkpoint_wal():
+    # own short-lived connection: a PASSIVE checkpoint never blocks the writer,
+    # and the writer never has to stop and checkpoint mid-commit
+    conn = sqlite3.connect(DB_PATH, timeout=15)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+    finally:
+        conn.close()
+
+async def checkpointer():
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_SECS)
+        try:
+            await asyncio.to_thread(checkpoint_wal)
+        except Exception:
+            log.exception("WAL checkpoint failed")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _queue
+    init_db()
+    _queue = asyncio.Queue()
+    task = asyncio.create_task(flusher())
+    ckpt = asyncio.create_task(checkpointer())
+    yield
+    ckpt.cancel()
+    _queue.put_nowait(_STOP)  # commit anything still queued before closing
+    await task
+    close_csv()
+    close_db()  # last connection to close checkpoints the WAL
+
+app = FastAPI(title=APP_NAME, lifespan=lifespan, default_response_class=FastJSONResponse)
 
 def check_auth(token_q: Optional[str], auth_h: Optional[str]):
+    # constant-time compares on bytes (compare_digest rejects non-ASCII str)
     ok = False
-    if URL_TOKEN and token_q == URL_TOKEN:
+    if _URL_TOKEN_B and token_q and hmac.compare_digest(token_q.encode(), _URL_TOKEN_B):
+        ok = True
+    if (not ok and _HEADER_SECRET_B and auth_h and auth_h[:7].lower() == "bearer "
+            and hmac.compare_digest(auth_h[7:].strip().encode(), _HEADER_SECRET_B)):
         ok = True
-    if not ok and HEADER_SECRET and auth_h:
-        parts = auth_h.split()
-        if len(parts) == 2 and parts[0].lower() == "bearer" and parts[1] == HEADER_SECRET:
-            ok = True
     if not ok:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
@@ -203,57 +437,94 @@ def health():
     # Do not leak full tokens in logs or responses
     return {"app": APP_NAME, "status": "ok", "data_dir": DATA_DIR}
 
+# Stays async on purpose: nothing here blocks (store_* only enqueue; the
+# flusher does all sqlite/CSV I/O via to_thread), and asyncio.Queue.put_nowait
+# is only safe from the loop thread, so a threadpool `def` would be wrong.
 @app.post("/ingest")
 async def ingest(request: Request,
                  token: Optional[str] = Query(None),
                  authorization: Optional[str] = Header(None)):
     check_auth(token, authorization)
 
-    body = await request.body()
-    raw = body.decode("utf-8").strip()
+    cl = request.headers.get("content-length", "")
+    if cl.isdigit() and int(cl) > MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    body = b""
+    async for chunk in request.stream():  # also caps chunked bodies with no length
+        body += chunk
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    body = body.strip()
 
-    # some TV setups send JSON {"message": "..."}
-    if not raw:
+    # some TV setups send JSON {"message": "..."}; only those pay for json parsing
+    if request.headers.get("content-type", "").startswith("application/json"):
         try:
-            payload = await request.json()
-            raw = (payload.get("message") or "").strip()
-        except Exception:
+            body = (json.loads(body).get("message") or "").strip().encode("utf-8")
+        except Exception:  # malformed wrapper (bad JSON, too deep, no .get) -> 400/422 below
             pass
-    if not raw:
+    if not body:
         raise HTTPException(status_code=400, detail="Empty payload")
 
-    if seen(raw):
-        return JSONResponse({"status":"dup", "len": len(raw)})
+    # decode before seen(): a body rejected here must not be recorded as a dup
+    try:
+        msg = body.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Parse error: {e}")
+
+    # dedupe still hashes the raw bytes, not the decoded str
+    if seen(body):
+        return FastJSONResponse({"status":"dup", "len": len(body)})
 
     try:
-        kind = classify_and_store(raw)
+        kind = classify_and_store(msg)
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Parse error: {e}")
 
-    return JSONResponse({"status":"ok", "kind": kind, "len": len(raw)})
+    # row is queued, not yet committed
+    return FastJSONResponse({"status":"ok", "kind": kind, "len": len(body)}, status_code=202)
 
 # CSV export endpoints (for Excel)
+EXPORT_CHUNK_ROWS = 500
+
+_SEL_DAY = {
+    "trades": "SELECT * FROM trades WHERE ts_utc>=? AND ts_utc<? ORDER BY ts_utc ASC",
+    "market": "SELECT * FROM market WHERE ts_utc>=? AND ts_utc<? ORDER BY ts_utc ASC",
+}
+
+def csv_chunks(kind: str, t0: int, t1: int):
+    # the pooled reader is taken on first iteration and held until the last
+    # chunk (export_csv primes it, see there); one StringIO reused per chunk
+    # keeps memory O(chunk)
+    with ro_db() as conn:
+        cur = conn.execute(_SEL_DAY[kind], (t0, t1))
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow([c[0] for c in cur.description])
+        try:
+            while True:
+                rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                w.writerows(rows)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():  # header only, no rows
+                yield buf.getvalue()
+        finally:
+            cur.close()
+
 def export_csv(kind: str, date_str: Optional[str]):
-    conn = db()
     if not date_str:
-        date_str = dt.datetime.utcnow().strftime("%Y-%m-%d")
+        date_str = time.strftime("%Y-%m-%d", time.gmtime())
     d0 = dt.datetime.strptime(date_str, "%Y-%m-%d")
-    t0 = int(d0.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    t0 = int(d0.replace(tzinfo=dt.timezone.utc).timestamp())
     t1 = t0 + 86400
-    if kind == "trades":
-        cur = conn.execute("SELECT * FROM trades WHERE ts_utc>=? AND ts_utc<? ORDER BY ts_utc ASC", (t0,t1))
-        cols = [c[0] for c in cur.description]
-    else:
-        cur = conn.execute("SELECT * FROM market WHERE ts_utc>=? AND ts_utc<? ORDER BY ts_utc ASC", (t0,t1))
-        cols = [c[0] for c in cur.description]
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(cols)
-    for row in cur:
-        w.writerow(row)
-    conn.close()
-    buf.seek(0)
-    return StreamingResponse(iter([buf.getvalue()]),
+    # pull the first chunk now: a busy pool becomes a real 503 before headers
+    # go out, and a started generator always releases its reader on close
+    chunks = csv_chunks(kind, t0, t1)
+    first = next(chunks)
+    return StreamingResponse(chain((first,), chunks),
                              media_type="text/csv",
                              headers={"Content-Disposition": f"attachment; filename={kind}_{d0.strftime('%Y%m%d')}.csv"})
 